@@ -16,92 +16,198 @@
 # limitations under the License.
 
 
-from pyzotero import zotero
-from pprint import pprint
 from ConfigParser import SafeConfigParser
 import sys
 import os
 import argparse
 import pickle
+import functools
+import re
+import unicodedata
+import datetime
+import collections
+import operator
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+CACHE_DIR = os.path.expanduser('~/.cache/cli-zotero')
+
+# Converting fewer items is faster than starting worker processes
+MIN_ITEMS_FOR_PROCESSES = 1000
+
+# Maximum number of items the Zotero API returns in one response
+PAGE_SIZE = 100
+
+# Zotero item types with a dedicated BibTeX entry type, others are misc
+_BIB_TYPES = {
+    'journalArticle': 'article',
+    'conferencePaper': 'inproceedings',
+    'bookSection': 'incollection',
+    'book': 'book',
+    'thesis': 'mastersthesis',
+}
+
+# Child items that are not exported at all
+_SKIPPED_TYPES = frozenset([ 'attachment', 'note' ])
+
+# Item types exported with their URL in the howpublished field
+_HOWPUBLISHED_TYPES = frozenset([ 'blogPost', 'webpage', 'computerProgram' ])
+
+def url_to_latex(url):
+    return '\\url{%s}' % url
+
+def pages_to_latex(pages):
+    return pages.replace('-', '--')
+
+# Simple fields copied from Zotero to BibTeX, as tuples
+# (BibTeX field, Zotero fields (first non-empty wins), escape, protect, conversion).
+# They are split into groups to keep the order of fields in the output.
+_FIELDS_TITLE = (
+    ('title', ('title',), True, True, None),
+)
+_FIELDS_HOWPUBLISHED = (
+    ('howpublished', ('url',), True, False, url_to_latex),
+)
+_FIELDS_PUBLICATION = (
+    ('booktitle', ('proceedingsTitle', 'bookTitle'), True, True, None),
+    ('journal', ('publicationTitle',), True, True, None),
+)
+_FIELDS_PUBLISHER = (
+    ('publisher', ('publisher',), True, False, None),
+    ('series', ('series',), True, True, None),
+    ('number', ('seriesNumber', 'issue'), True, False, None),
+    ('type', ('thesisType',), True, False, None),
+    ('school', ('university',), True, False, None),
+)
+_FIELDS_THESIS_PLACE = (
+    ('address', ('place',), True, False, None),
+)
+_FIELDS_PLACE = (
+    ('location', ('place',), True, False, None),
+)
+_FIELDS_OTHER = (
+    ('isbn', ('ISBN',), True, False, None),
+    ('issn', ('ISSN',), True, False, None),
+    ('pages', ('pages',), True, False, pages_to_latex),
+    ('url', ('url',), True, False, None),
+    ('volume', ('volume',), True, False, None),
+    ('shorttitle', ('shortTitle',), True, False, None),
+    ('abstract', ('abstractNote',), True, False, None),
+)
+
+_BIBTEX_RE = re.compile(r'^bibtex:[ \t]*(.*)$', re.MULTILINE)
+_DOI_RE = re.compile(r'^doi:[ \t]*(.*)$', re.IGNORECASE | re.MULTILINE)
+_YEAR_RE = re.compile(r'(?<![0-9])[0-9]{4}(?![0-9])')
+_NON_ASCII_RE = re.compile(u'[^\x00-\x7f]')
+_NONALPHA_RE = re.compile(r'[\W\d_]+', re.UNICODE)
+_NONALNUM_RE = re.compile(r'[\W_]+', re.UNICODE)
+
+def memoize(func):
+    cache = {}
+    @functools.wraps(func)
+    def wrapper(arg):
+        try:
+            return cache[arg]
+        except KeyError:
+            result = cache[arg] = func(arg)
+            return result
+    return wrapper
+
+# Translation table removing non-spacing marks, filled in on first use
+# of each character (building it for the whole Unicode range upfront
+# takes longer than stripping accents of a typical collection).
+class CombiningMarksTable(dict):
+    def __missing__(self, codepoint):
+        if unicodedata.category(unichr(codepoint)) == 'Mn':
+            value = None
+        else:
+            value = codepoint
+        self[codepoint] = value
+        return value
+
+_COMBINING_MARKS = CombiningMarksTable()
 
 # http://stackoverflow.com/a/518232/1360886
+@memoize
 def strip_accents(s):
-    import unicodedata
-    return ''.join(c for c in unicodedata.normalize('NFD', s)
-                   if unicodedata.category(c) != 'Mn')
+    # Pure ASCII strings have nothing to strip
+    if not _NON_ASCII_RE.search(s):
+        return s
+    return unicodedata.normalize('NFD', s).translate(_COMBINING_MARKS)
+
+_LATEX_TABLE = {
+    ord(u'\u2013'): u'--',
+    ord(u'&'): u'\\&',
+    ord(u'%'): u'\\%',
+    ord(u'#'): u'\\#',
+}
 
 def latex_escape(s):
-    return s.replace(u'\u2013', '--').replace(u'&', '\\&').replace(u'%', '\\%').replace(u'#', '\\#')
+    return s.translate(_LATEX_TABLE)
 
-def parse_date_guessing(datestr):
-    import datetime
-    for fmt in [ "%B %d %Y", "%B %d, %Y", "%B %Y", "%Y", "%Y/%m/%d", "%Y-%m-%d" ]:
-        try:
-            return datetime.datetime.strptime(datestr, fmt)
-        except ValueError as e:
-            pass
-    return datetime.datetime.today()
+def year_of(datestr):
+    # Zotero dates mostly start with the year
+    if datestr[:4].isdigit():
+        return int(datestr[:4])
+    m = _YEAR_RE.search(datestr)
+    if m:
+        return int(m.group(0))
+    return datetime.date.today().year
+
+_USELESS_WORDS = frozenset('a an the on for'.split())
 
 def skip_useless_words(where):
-    useless_words = 'a an the on for'.split()
-    idx = 0
-    while where[idx].lower() in useless_words:
-        idx = idx + 1
-    return where[idx]
-
-def get_first_author(item):
-    author = item['data']['creators'][0]
+    for word in where:
+        if word.lower() not in _USELESS_WORDS:
+            return word
+    # Title made of useless words only, better than nothing
+    if where:
+        return where[-1]
+    return ''
+
+def get_first_author(data):
+    author = data['creators'][0]
     if 'lastName' in author:
         return author['lastName']
     else:
         return author['name']
 
-def make_bibtex_key(item):
-    if 'extra' in item['data']:
-        import re
-        lines = item['data']['extra'].split('\n')
-        pat = re.compile('bibtex:[ \t]*(.*)')
-        for l in lines:
-            m = pat.match(l)
-            if m:
-                return m.group(1)
-    author = filter(unicode.isalpha, strip_accents(get_first_author(item)).lower())
-    year = parse_date_guessing(item['data']['date']).year
-    title_words = strip_accents(item['data']['title']).split()
-    title_start = filter(unicode.isalnum, skip_useless_words(title_words).lower())
-    return "%s_%s_%s" % (author, title_start, year)
-
-def make_sort_key(item):
-    if item['data']['itemType'] == 'attachment':
-        return 'xxx'
-    author = strip_accents(get_first_author(item)).lower()
-    year = parse_date_guessing(item['data']['date']).year
-    title_words = strip_accents(item['data']['title']).split()
-    title_start = skip_useless_words(title_words).lower()
-    return "%s %s %s" % (year, author, title_start)
+def get_bibtex_key_override(data):
+    m = _BIBTEX_RE.search(data.get('extra', ''))
+    if m:
+        return m.group(1)
+    return None
+
+ItemKeys = collections.namedtuple('ItemKeys', 'sort_key bibtex_key year')
+
+# Sort key and BibTeX key are built from the same normalized author,
+# year and title, so compute them together (once per item).
+def item_keys(item):
+    data = item['data']
+    if data['itemType'] in _SKIPPED_TYPES:
+        return ItemKeys('xxx', None, None)
+    else:
+        author = strip_accents(get_first_author(data)).lower()
+        year = year_of(data.get('date', ''))
+        title_words = strip_accents(data['title']).split()
+        title_start = skip_useless_words(title_words).lower()
+        sort_key = "%s %s %s" % (year, author, title_start)
+        bibtex_key = get_bibtex_key_override(data)
+        if bibtex_key is None:
+            bibtex_key = "%s_%s_%s" % (_NONALPHA_RE.sub('', author),
+                _NONALNUM_RE.sub('', title_start), year)
+        return ItemKeys(sort_key, bibtex_key, year)
     
 
-def item_to_bibtex(item):
-    def shall_skip(item):
-        if item['data']['itemType'] == 'attachment':
-            return True
-        else:
-            return False
-        
-    def bib_type(item):
-        if item['data']['itemType'] == 'journalArticle':
-            return 'article'
-        elif item['data']['itemType'] == 'conferencePaper':
-            return 'inproceedings'
-        elif item['data']['itemType'] == 'bookSection':
-            return 'incollection'
-        elif item['data']['itemType'] == 'book':
-            return 'book'
-        elif item['data']['itemType'] == 'thesis':
-            return 'mastersthesis'
-        else:
-            return 'misc'
+def item_to_bibtex(item, keys=None):
+    data = item['data']
+    item_type = data['itemType']
+    if item_type in _SKIPPED_TYPES:
+        return None
     
+    creators = data['creators']
+    parts = []
+
     def make_author_list(creators, creator_type = None):
         # By default, we try to collect only authors.
         # If there is no author explicitly specify, we take everybody
@@ -128,89 +234,227 @@ def item_to_bibtex(item):
     def print_key(key, value, print_empty = True):
         if (not print_empty) and (value == ''):
             return
-        print('    %s = {%s},' % (key, value.encode('utf-8')))
+        parts.append(u'    %s = {%s},\n' % (key, value))
     
-    def has_field(zoterokey, item):
-        return zoterokey in item['data'] and item['data'][zoterokey] != ''
+    def add_fields(fields):
+        for bibtexkey, zoterokeys, escape, protect, conversion in fields:
+            for key in zoterokeys:
+                value = data.get(key)
+                if value:
+                    if not conversion is None:
+                        value = conversion(value)
+                    if escape:
+                        value = latex_escape(value)
+                    if protect:
+                        value = "{%s}" % value
+                    print_key(bibtexkey, value)
+                    # Use first match only
+                    break
     
-    def try_field(bibtexkey, zoterokeys, item, escape=True, protect=False, conversion=None):
-        if not type(zoterokeys) is list:
-            zoterokeys = [ zoterokeys ]
-        for key in zoterokeys:
-            if (key in item['data']) and (item['data'][key] != ''):
-                value = item['data'][key]
-                if not conversion is None:
-                    value = conversion(value)
-                if escape:
-                    value = latex_escape(value)
-                if protect:
-                    value = "{%s}" % value
-                print_key(bibtexkey, value)
-                # Exit after first match
-                return
-    
-    def get_doi(item):
-        if ('DOI' in item['data']) and (item['data']['DOI'] != ''):
-            return item['data']['DOI']
+    def get_doi():
+        doi = data.get('DOI')
+        if doi:
+            return doi
         else:
-            import re
-            lines = item['data']['extra'].split('\n')
-            pat = re.compile('[dD][oO][iI]:[ \t]*(.*)')
-            for l in lines:
-                m = pat.match(l)
-                if m:
-                    return m.group(1)
+            m = _DOI_RE.search(data.get('extra', ''))
+            if m:
+                return m.group(1)
             return ''
 
-    if shall_skip(item):
-        return
+    if keys is None:
+        keys = item_keys(item)
     
-    print('@%s{%s,' % (bib_type(item), make_bibtex_key(item)))
+    parts.append(u'@%s{%s,\n' % (_BIB_TYPES.get(item_type, 'misc'), keys.bibtex_key))
     
-    try_field('title', 'title', item, protect=True)
-    print_key('author', make_author_list(item['data']['creators']))
+    add_fields(_FIELDS_TITLE)
+    print_key('author', make_author_list(creators))
     
-    print_key('year', '%d' % parse_date_guessing(item['data']['date']).year)
+    print_key('year', '%d' % keys.year)
     
     # Not so traditional types are distinguished by howpublished field for now
-    if item['data']['itemType'] in [ 'blogPost', 'webpage', 'computerProgram' ]:
-        try_field('howpublished', 'url', item, conversion=lambda x : '\\url{%s}' % x)
-    if item['data']['itemType'] == 'presentation':
-        if has_field('meetingName', item):
-            s = 'Presentation at {%s}' % item['data']['meetingName']
-            if has_field('url', item):
-                s = '%s, \\url{%s}' % (s, item['data']['url'])
+    if item_type in _HOWPUBLISHED_TYPES:
+        add_fields(_FIELDS_HOWPUBLISHED)
+    if item_type == 'presentation':
+        meeting = data.get('meetingName')
+        if meeting:
+            s = 'Presentation at {%s}' % meeting
+            url = data.get('url')
+            if url:
+                s = '%s, %s' % (s, url_to_latex(url))
             print_key('howpublished', s)
     
-    try_field('booktitle', [ 'proceedingsTitle', 'bookTitle' ], item, protect=True)
-    try_field('journal', 'publicationTitle', item, protect=True)
-    print_key('editor', make_author_list(item['data']['creators'], 'editor'), False)
-    try_field('publisher', 'publisher', item)
-    try_field('series', 'series', item, protect=True)
-    try_field('number', [ 'seriesNumber', 'issue' ], item)
-
-    try_field('type', 'thesisType', item)
-    try_field('school', 'university', item)
-    if item['data']['itemType'] == 'thesis':
-        try_field('address', 'place', item)
+    add_fields(_FIELDS_PUBLICATION)
+    print_key('editor', make_author_list(creators, 'editor'), False)
+    add_fields(_FIELDS_PUBLISHER)
+    if item_type == 'thesis':
+        add_fields(_FIELDS_THESIS_PLACE)
     else:
-        try_field('location', 'place', item)
+        add_fields(_FIELDS_PLACE)
     
-    item_doi = get_doi(item)
+    item_doi = get_doi()
     if item_doi != '':
         print_key('doi', item_doi)
-    try_field('isbn', 'ISBN', item)
-    try_field('issn', 'ISSN', item)
+    add_fields(_FIELDS_OTHER)
+    
+    parts.append(u'}\n\n')
+    
+    return u''.join(parts)
+
+def convert_item(item):
+    keys = item_keys(item)
+    return (keys.sort_key, item_to_bibtex(item, keys))
+
+# Number of processes to convert count items with, 1 means no workers
+def conversion_processes(jobs, count):
+    # Conversion is CPU-bound, more processes than CPUs do not help
+    jobs = min(jobs, multiprocessing.cpu_count())
+    if jobs > 1 and count >= MIN_ITEMS_FOR_PROCESSES:
+        return jobs
+    return 1
+
+# Returns list of (sort key, BibTeX record) pairs in the order of items
+def convert_items(items, jobs):
+    processes = conversion_processes(jobs, len(items))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(convert_item, items, chunksize=64)
+        finally:
+            pool.close()
+    return [ convert_item(item) for item in items ]
+
+def write_bibtex(record):
+    if record is not None:
+        sys.stdout.write(record.encode('utf-8'))
+
+# Without fmt, pages are lists of items. With fmt (e.g. 'bibtex'), pages
+# are whatever the Zotero client returns for that format.
+def iter_collection_pages(new_client, collection, page_size, jobs, fmt=None, total=None):
+    zot = new_client()
+    if total is None:
+        total = zot.num_collectionitems(collection)
+    params = {}
+    if fmt is not None:
+        params['format'] = fmt
+    
+    def fetch_page(start):
+        # Zotero client keeps state of the last request, use one per page
+        return new_client().collection_items(collection, limit=page_size, start=start, **params)
+    
+    # Pages are yielded in order, each as soon as it (and its predecessors)
+    # is retrieved
+    count = 0
+    pool = ThreadPool(jobs)
+    try:
+        for page in pool.imap(fetch_page, range(0, total, page_size)):
+            if fmt is None:
+                count = count + len(page)
+            yield page
+    finally:
+        pool.close()
+    
+    # Formatted pages skip attachments and notes, so their size does not
+    # tell how many items were retrieved and where to continue
+    if fmt is not None:
+        return
+    
+    # Pick up items added since we asked for the total
+    while True:
+        next_items = zot.collection_items(collection, limit=page_size, start=count)
+        if len(next_items) == 0:
+            break
+        count = count + len(next_items)
+        yield next_items
 
-    try_field('pages', 'pages', item, conversion=lambda x : x.replace('-', '--'))
+# Page converted in this process, mimics AsyncResult of a pool
+class ConvertedPage(object):
+    def __init__(self, records):
+        self.records = records
+    
+    def ready(self):
+        return True
+    
+    def get(self):
+        return self.records
 
-    try_field('url', 'url', item)
-    try_field('volume', 'volume', item)
-    try_field('shorttitle', 'shortTitle', item)
-    try_field('abstract', 'abstractNote', item)
+# Retrieves collection items, converting each page as soon as it arrives
+# (in worker processes for large collections). Returns the items and their
+# (sort key, BibTeX record) pairs; with write_now, records are written out
+# in page order instead and the returned list is empty.
+def fetch_and_convert_items(new_client, collection, page_size, jobs, write_now):
+    total = new_client().num_collectionitems(collection)
+    processes = conversion_processes(jobs, total)
+    # Start worker processes before the download threads exist
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+    
+    items = []
+    records = []
+    pending = []
+    
+    def finish_pages(wait):
+        # Keep page order, stop at the first page still being converted
+        while pending and (wait or pending[0].ready()):
+            page_records = pending.pop(0).get()
+            if write_now:
+                for sort_key, record in page_records:
+                    write_bibtex(record)
+            else:
+                records.extend(page_records)
     
-    print('}\n')
+    try:
+        for page in iter_collection_pages(new_client, collection, page_size, jobs, total=total):
+            # Convert items while the following pages are being retrieved
+            if pool is None:
+                pending.append(ConvertedPage([ convert_item(item) for item in page ]))
+            else:
+                pending.append(pool.map_async(convert_item, page))
+            finish_pages(False)
+            items.extend(page)
+        finish_pages(True)
+    finally:
+        if pool is not None:
+            pool.close()
+    return items, records
+
+def write_server_bibtex(new_client, collection, page_size, jobs):
+    # Zotero client returns BibTeX parsed through bibtexparser
+    from bibtexparser.bwriter import BibTexWriter
+    # Keep the server order, the writer sorts entries by key by default
+    writer = BibTexWriter()
+    writer.order_entries_by = None
+    for page in iter_collection_pages(new_client, collection, page_size, jobs, 'bibtex'):
+        sys.stdout.write(writer.write(page).encode('utf-8'))
+
+def load_cached_items(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+def store_cached_items(cache_dir, cache_prefix, cache_name, items):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Remove data cached for older versions of the library
+        for name in os.listdir(cache_dir):
+            if name.startswith(cache_prefix):
+                os.remove(os.path.join(cache_dir, name))
+        cache_file = os.path.join(cache_dir, cache_name)
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump(items, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(cache_file + '.tmp', cache_file)
+    except (IOError, OSError) as e:
+        sys.stderr.write('Failed to cache retrieved items: %s\n' % e)
+
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got %s' % value)
+    return number
 
 class MyConfigParser(SafeConfigParser):
     def __init__(self):
@@ -222,99 +466,161 @@ class MyConfigParser(SafeConfigParser):
         else:
             return default_value
 
-cfgfile = MyConfigParser()
-cfgfile.read(os.path.expanduser('~/.config/cli-zotero.conf'))
-
-parser = argparse.ArgumentParser(description='Command-line client for Zotero')
-
-parser.add_argument('--key',
-        dest='key',
-        required=not cfgfile.has_option('core', 'key'),
-        default=cfgfile.get_with_default('core', 'key'),
-        metavar='API-KEY',
-        help='Zotero API key (https://www.zotero.org/settings/keys)\nOr specify in [core] of configuration file.')
-
-identity_opts = parser.add_mutually_exclusive_group(required=True)
-identity_opts.add_argument('--group',
-        dest='group',
-        metavar='ID',
-        type=int,
-        help='Group ID (https://www.zotero.org/groups/)')
-identity_opts.add_argument('--user',
-        dest='user',
-        metavar='ID',
-        type=int,
-        help='User ID (https://www.zotero.org/settings/keys)')
-identity_opts.add_argument('--id',
-        dest='identity',
-        metavar='NAME',
-        help='Identity specified in [identities] in configuration file.')
-
-action_args = parser.add_mutually_exclusive_group(required=True)
-action_args.add_argument('--list-collections',
-        dest='collection_filter',
-        nargs='?',
-        const='',
-        metavar='TITLE',
-        help='List your collections (title partial match)')
-action_args.add_argument('--collection-to-bibtex',
-        dest='collection_to_bibtex',
-        metavar='COLLECTION-ID',
-        help='Export given collection to BibTeX')
-
-parser.add_argument('--dump',
-        dest='dump_file',
-        metavar='FILENAME',
-        help='Dump retrieved data through pprint to FILENAME')
-
-parser.add_argument('--limit',
-        dest='limit',
-        type=int,
-        default=30,
-        metavar='N',
-        help='Set internal limit of the queries')
-
-cfg = parser.parse_args()
-
-zot = None
-if cfg.group:
-    zot = zotero.Zotero(cfg.group, 'group', cfg.key)
-elif cfg.user:
-    zot = zotero.Zotero(cfg.user, 'user', cfg.key)
-else:
-    id_line = cfgfile.get_with_default('identities', cfg.identity)
-    if id_line is None:
-        sys.exit('Unknown identity "%s".' % cfg.identity)
-    id_parts = id_line.split()
-    if len(id_parts) != 2 or (id_parts[0] not in ['user', 'group' ]):
-        sys.exit('Wrong identity configuration "%s".' % id_line)
-    zot = zotero.Zotero(id_parts[1], id_parts[0], cfg.key)
-
-
-if not cfg.collection_filter is None:
-    all_collections = zot.collections(q=cfg.collection_filter, limit=cfg.limit)
-    if cfg.dump_file:
-        with open(cfg.dump_file, "w") as f:
-            pprint(all_collections, f)
-    for col in all_collections:
-        print("%s - %s" % (col['key'], col['data']['name']))
-    sys.exit()
-
-if cfg.collection_to_bibtex:
-    items = []
-    start_index = 0
-    while True:
-        next_items = zot.collection_items(cfg.collection_to_bibtex, limit=cfg.limit, start=start_index)
-        if len(next_items) == 0:
-            break
-        items.extend(next_items)
-        start_index = start_index + len(next_items)
-    if cfg.dump_file:
-        with open(cfg.dump_file, "w") as f:
-            pprint(items, f)
-    items = sorted(items, key=make_sort_key)
-    for item in items:
-        item_to_bibtex(item)
-    sys.exit()
-
-parser.print_help()
+def main():
+    cfgfile = MyConfigParser()
+    cfgfile.read(os.path.expanduser('~/.config/cli-zotero.conf'))
+
+    parser = argparse.ArgumentParser(description='Command-line client for Zotero')
+
+    parser.add_argument('--key',
+            dest='key',
+            required=not cfgfile.has_option('core', 'key'),
+            default=cfgfile.get_with_default('core', 'key'),
+            metavar='API-KEY',
+            help='Zotero API key (https://www.zotero.org/settings/keys)\nOr specify in [core] of configuration file.')
+
+    identity_opts = parser.add_mutually_exclusive_group(required=True)
+    identity_opts.add_argument('--group',
+            dest='group',
+            metavar='ID',
+            type=int,
+            help='Group ID (https://www.zotero.org/groups/)')
+    identity_opts.add_argument('--user',
+            dest='user',
+            metavar='ID',
+            type=int,
+            help='User ID (https://www.zotero.org/settings/keys)')
+    identity_opts.add_argument('--id',
+            dest='identity',
+            metavar='NAME',
+            help='Identity specified in [identities] in configuration file.')
+
+    action_args = parser.add_mutually_exclusive_group(required=True)
+    action_args.add_argument('--list-collections',
+            dest='collection_filter',
+            nargs='?',
+            const='',
+            metavar='TITLE',
+            help='List your collections (title partial match)')
+    action_args.add_argument('--collection-to-bibtex',
+            dest='collection_to_bibtex',
+            metavar='COLLECTION-ID',
+            help='Export given collection to BibTeX')
+
+    parser.add_argument('--dump',
+            dest='dump_file',
+            metavar='FILENAME',
+            help='Dump retrieved data through pprint to FILENAME')
+
+    parser.add_argument('--limit',
+            dest='limit',
+            type=int,
+            default=PAGE_SIZE,
+            metavar='N',
+            help='Limit the number of listed collections (at most %d)' % PAGE_SIZE)
+
+    parser.add_argument('--server-bibtex',
+            dest='server_bibtex',
+            action='store_true',
+            help='Let the Zotero server format the BibTeX (faster, but keys and fields differ, entries are in server order and not cached)')
+
+    parser.add_argument('--no-sort',
+            dest='sort',
+            action='store_false',
+            help='Print items in the order they are retrieved, as soon as they arrive')
+
+    parser.add_argument('--no-cache',
+            dest='use_cache',
+            action='store_false',
+            help='Always retrieve items from the server, ignoring ~/.cache/cli-zotero')
+
+    parser.add_argument('--jobs',
+            dest='jobs',
+            type=positive_int,
+            default=4,
+            metavar='N',
+            help='Number of parallel requests and conversion processes')
+
+    cfg = parser.parse_args()
+    if cfg.server_bibtex:
+        if not cfg.collection_to_bibtex:
+            parser.error('--server-bibtex can be used only with --collection-to-bibtex')
+        if cfg.dump_file:
+            parser.error('--dump cannot be combined with --server-bibtex')
+
+    # Zotero client pulls in a lot of modules, not needed for --help
+    from pyzotero import zotero
+
+    library_id = None
+    library_type = None
+    if cfg.group:
+        library_id, library_type = cfg.group, 'group'
+    elif cfg.user:
+        library_id, library_type = cfg.user, 'user'
+    else:
+        id_line = cfgfile.get_with_default('identities', cfg.identity)
+        if id_line is None:
+            sys.exit('Unknown identity "%s".' % cfg.identity)
+        id_parts = id_line.split()
+        if len(id_parts) != 2 or (id_parts[0] not in ['user', 'group' ]):
+            sys.exit('Wrong identity configuration "%s".' % id_line)
+        library_id, library_type = id_parts[1], id_parts[0]
+
+    def new_client():
+        return zotero.Zotero(library_id, library_type, cfg.key)
+
+    zot = new_client()
+
+
+    if not cfg.collection_filter is None:
+        all_collections = zot.collections(q=cfg.collection_filter, limit=cfg.limit)
+        if cfg.dump_file:
+            from pprint import pprint
+            with open(cfg.dump_file, "w") as f:
+                pprint(all_collections, f)
+        for col in all_collections:
+            print("%s - %s" % (col['key'], col['data']['name']))
+        sys.exit()
+
+    if cfg.collection_to_bibtex and cfg.server_bibtex:
+        write_server_bibtex(new_client, cfg.collection_to_bibtex, PAGE_SIZE, cfg.jobs)
+        sys.exit()
+
+    if cfg.collection_to_bibtex:
+        items = None
+        use_cache = cfg.use_cache
+        if use_cache:
+            # Any change in the library bumps its version, invalidating the cache.
+            # The version comes from response headers, one item is enough.
+            version = zot.last_modified_version(limit=1)
+            # Zero means the server did not tell us the version
+            use_cache = version != 0
+        if use_cache:
+            cache_prefix = '%s-%s-%s-' % (library_type, library_id, cfg.collection_to_bibtex)
+            cache_name = '%s%d.pkl' % (cache_prefix, version)
+            items = load_cached_items(os.path.join(CACHE_DIR, cache_name))
+        records = None
+        streamed = False
+        if items is None:
+            items, records = fetch_and_convert_items(new_client,
+                cfg.collection_to_bibtex, PAGE_SIZE, cfg.jobs, not cfg.sort)
+            streamed = not cfg.sort
+            if use_cache:
+                store_cached_items(CACHE_DIR, cache_prefix, cache_name, items)
+        if cfg.dump_file:
+            from pprint import pprint
+            with open(cfg.dump_file, "w") as f:
+                pprint(items, f)
+        if records is None:
+            records = convert_items(items, cfg.jobs)
+        if not streamed:
+            if cfg.sort:
+                records.sort(key=operator.itemgetter(0))
+            for sort_key, record in records:
+                write_bibtex(record)
+        sys.exit()
+
+    parser.print_help()
+
+if __name__ == '__main__':
+    main()